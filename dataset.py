@@ -10,11 +10,13 @@ class SpeechesClassificationDataset(Dataset):
     Args:
         tokenizer (Tokenizer): The tokenizer used to encode the text.
         file_path (str): The path to the file containing the speech classification data.
+        block_size (int): Fixed length every sample is truncated/zero-padded to.
 
     """
 
-    def __init__(self, tokenizer, file_path):
+    def __init__(self, tokenizer, file_path, block_size=32):
         self.tokenizer = tokenizer
+        self.block_size = block_size
         self.samples = []
 
         if not os.path.exists(file_path):
@@ -34,9 +36,15 @@ class SpeechesClassificationDataset(Dataset):
 
     def __getitem__(self, index):
         label, text = self.samples[index]
-        input_ids = torch.tensor(self.tokenizer.encode(text), dtype=torch.long)
+        # Emit a fixed-length, zero-padded tensor so the default collate is a plain torch.stack
+        # (no pad_sequence/slice/re-pad work on the main thread, and num_workers can parallelize it).
+        # A <cls> token is prepended; the classifier reads its final embedding as the
+        # sequence summary instead of mean-pooling over all positions.
+        ids = ([self.tokenizer.stoi['<cls>']] + self.tokenizer.encode(text))[:self.block_size]
+        input_ids = torch.zeros(self.block_size, dtype=torch.long)
+        input_ids[:len(ids)] = torch.tensor(ids, dtype=torch.long)
         label_tensor = torch.tensor(label, dtype=torch.long)
-        
+
         return input_ids, label_tensor
     
     
@@ -61,7 +69,8 @@ class LanguageModelingDataset(torch.utils.data.Dataset):
         return len(self.data) - self.block_size
 
     def __getitem__(self, idx):
-        chunk = self.data[idx:idx + self.block_size + 1]
-        x = chunk[:-1]
-        y = chunk[1:]
+        # The corpus is tokenized once into self.data at init; each sample is just
+        # two zero-copy views into that tensor (no per-item Python tokenization)
+        x = self.data[idx:idx + self.block_size]
+        y = self.data[idx + 1:idx + 1 + self.block_size]
         return x, y
\ No newline at end of file
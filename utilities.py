@@ -1,7 +1,6 @@
 
 import matplotlib.pyplot as plt
 import torch
-from transformer import create_mask
 
 class Utilities:
     def __init__(self, tokenizer, model):
@@ -12,9 +11,9 @@ class Utilities:
         # Encode the sentence using the tokenizer
         wordids = self.tokenizer.encode(sentence)
 
-        # Prepare the padded input for the model
+        # Prepare the padded input for the model (batch-first: (1, block_size))
         padded_sentence = wordids[:block_size] + [0] * (block_size - len(wordids))
-        input_tensor = torch.tensor(padded_sentence, dtype=torch.long).unsqueeze(1)
+        input_tensor = torch.tensor(padded_sentence, dtype=torch.long).unsqueeze(0)
 
         # Display input tensor shape
         print("Input tensor shape:", input_tensor.shape)
@@ -23,7 +22,7 @@ class Utilities:
         device = next(self.model.parameters()).device
         input_tensor = input_tensor.to(device)
         # Process the input tensor through the encoder model
-        _,  attn_maps = self.model(input_tensor) # Ignore the output of the model, and only get the attention maps; make sure your encoder returns the attention maps
+        _,  attn_maps = self.model(input_tensor, return_attn=True) # Ignore the output of the model, and only get the attention maps; make sure your encoder returns the attention maps
 
         # Display the number of attention maps
         print("Number of attention maps:", len(attn_maps))
@@ -55,23 +54,20 @@ class Utilities:
         # Encode the sentence using the tokenizer
         wordids = self.tokenizer.encode(sentence)
 
-        # Prepare the padded input for the model
+        # Prepare the padded input for the model (batch-first: (1, block_size))
         padded_sentence = wordids[:block_size] + [0] * (block_size - len(wordids))
-        input_tensor = torch.tensor(padded_sentence, dtype=torch.long).unsqueeze(1)
+        input_tensor = torch.tensor(padded_sentence, dtype=torch.long).unsqueeze(0)
 
-        # Display input tensor shape, should be (block_size, 1)
+        # Display input tensor shape, should be (1, block_size)
         print("Input tensor shape:", input_tensor.shape)
 
-        # Create the mask
-        mask = create_mask(input_tensor.size(0)).to(input_tensor.device)
-
         # Device management
         device = next(self.model.parameters()).device
         input_tensor = input_tensor.to(device)
-        mask = mask.to(device)
 
-        # Process the input tensor through the decoder model
-        _, attn_maps = self.model(input_tensor, mask)
+        # Process the input tensor through the decoder model;
+        # the decoder falls back to its registered causal_mask buffer
+        _, attn_maps = self.model(input_tensor, need_weights=True)
 
         # Display the number of attention maps
         print("Number of attention maps:", len(attn_maps))